@@ -13,7 +13,6 @@ References
 import argparse
 import random
 import warnings
-from math import sqrt
 from pathlib import Path
 
 import numpy as np
@@ -23,6 +22,7 @@ from sklearn.gaussian_process import GaussianProcessRegressor
 from sklearn.gaussian_process.kernels import DotProduct
 from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
 from sklearn.model_selection import StratifiedKFold
+from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import RobustScaler
 
 from utils import COLUMNS_NAME, load_freesurfer_dataset
@@ -115,7 +115,7 @@ def main(experiment_name, scanner_name, input_ids_file):
             predictions = model.predict(x_test)
 
             mae = mean_absolute_error(y_test, predictions)
-            rmse = sqrt(mean_squared_error(y_test, predictions))
+            rmse = mean_squared_error(y_test, predictions, squared=False)
             r, _ = stats.pearsonr(y_test, predictions)
             r2 = r2_score(y_test, predictions)
             age_error_corr, _ = stats.spearmanr((predictions - y_test), y_test)
@@ -130,9 +130,9 @@ def main(experiment_name, scanner_name, input_ids_file):
             # Save output files
             output_prefix = f'{i_repetition:02d}_{i_fold:02d}'
 
-            # Save scaler and model
-            dump(scaler, cv_dir / f'{output_prefix}_scaler.joblib')
-            dump(model, cv_dir / f'{output_prefix}_regressor.joblib')
+            # Save scaler and model as a single pipeline
+            pipeline = Pipeline([('scaler', scaler), ('regressor', model)])
+            dump(pipeline, cv_dir / f'{output_prefix}_model.joblib')
 
             # Save model scores
             scores_array = np.array([r, r2, mae, rmse, age_error_corr])
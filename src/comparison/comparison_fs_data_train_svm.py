@@ -14,7 +14,6 @@ Machine learning 20.3 (1995): 273-297.
 import argparse
 import random
 import warnings
-from math import sqrt
 from pathlib import Path
 
 import numpy as np
@@ -23,6 +22,7 @@ from scipy import stats
 from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
 from sklearn.model_selection import GridSearchCV
 from sklearn.model_selection import StratifiedKFold
+from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import RobustScaler
 from sklearn.svm import LinearSVR
 
@@ -131,7 +131,7 @@ def main(experiment_name, scanner_name, input_ids_file):
             predictions = model.predict(x_test)
 
             mae = mean_absolute_error(y_test, predictions)
-            rmse = sqrt(mean_squared_error(y_test, predictions))
+            rmse = mean_squared_error(y_test, predictions, squared=False)
             r, _ = stats.pearsonr(y_test, predictions)
             r2 = r2_score(y_test, predictions)
             age_error_corr, _ = stats.spearmanr((predictions - y_test), y_test)
@@ -146,9 +146,9 @@ def main(experiment_name, scanner_name, input_ids_file):
             # Save output files
             output_prefix = f'{i_repetition:02d}_{i_fold:02d}'
 
-            # Save scaler and model
-            dump(scaler, cv_dir / f'{output_prefix}_scaler.joblib')
-            dump(model, cv_dir / f'{output_prefix}_regressor.joblib')
+            # Save scaler and model as a single pipeline
+            pipeline = Pipeline([('scaler', scaler), ('regressor', model)])
+            dump(pipeline, cv_dir / f'{output_prefix}_model.joblib')
             dump(params_results, cv_dir / f'{output_prefix}_params.joblib')
 
             # Save model scores
@@ -14,7 +14,6 @@ References
 import argparse
 import random
 import warnings
-from math import sqrt
 from pathlib import Path
 
 import numpy as np
@@ -118,7 +117,7 @@ def main(experiment_name, scanner_name, input_ids_file):
             predictions = model.predict(x_test)
 
             mae = mean_absolute_error(y_test, predictions)
-            rmse = sqrt(mean_squared_error(y_test, predictions))
+            rmse = mean_squared_error(y_test, predictions, squared=False)
             r, _ = stats.pearsonr(y_test, predictions)
             r2 = r2_score(y_test, predictions)
             age_error_corr, _ = stats.spearmanr((predictions - y_test), y_test)
@@ -4,19 +4,20 @@ Tests models developed using FreeSurfer data from Biobank Scanner1
 on previously unseen data from Biobank Scanner2 to predict brain age.
 
 The script loops over the 100 models created in comparison_fs_data_train_svm.py
-and comparison_fs_data_train_rvm.py, loads their regressors, applies
+and comparison_fs_data_train_rvm.py, loads their pipelines (scaler and regressor), applies
 them to the Scanner2 data and saves all predictions per subjects
 in age_predictions_test.csv.
 """
 import argparse
 import random
-from math import sqrt
+from itertools import product
 from pathlib import Path
 
 import numpy as np
+import pandas as pd
 from joblib import load
 from scipy import stats
-from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+from sklearn.svm import LinearSVR
 
 from utils import COLUMNS_NAME, load_freesurfer_dataset
 
@@ -48,6 +49,46 @@ parser.add_argument('-I', '--input_ids_file',
 args = parser.parse_args()
 
 
+def fold_scalers_into_linear_models(models):
+    """Fold the RobustScaler of each pipeline into the weights of its linear regressor.
+
+    Since x_scaled = (x - center) / scale, the prediction w @ x_scaled + b equals
+    (w / scale) @ x + (b - (w / scale) @ center).
+
+    Args:
+        models: list of fitted pipelines with a RobustScaler 'scaler' step and a LinearSVR 'regressor' step
+
+    Returns:
+        weights: effective weights per model, shape (n_models, n_features).
+        intercepts: effective intercepts per model, shape (n_models,).
+    """
+    weights = []
+    intercepts = []
+    for pipeline in models:
+        scaler = pipeline.named_steps['scaler']
+        model = pipeline.named_steps['regressor']
+
+        coef = np.ravel(model.coef_)
+        if scaler.scale_ is not None:
+            coef = coef / scaler.scale_
+
+        intercept = np.ravel(model.intercept_)[0]
+        if scaler.center_ is not None:
+            intercept = intercept - coef @ scaler.center_
+
+        weights.append(coef)
+        intercepts.append(intercept)
+
+    return np.vstack(weights), np.array(intercepts)
+
+
+def corrcoef_columns(x, y):
+    """Pearson correlation coefficient between the vector x and each column of y."""
+    x_centered = x - x.mean()
+    y_centered = y - y.mean(axis=0)
+    return (x_centered @ y_centered) / (np.linalg.norm(x_centered) * np.linalg.norm(y_centered, axis=0))
+
+
 def main(training_experiment_name, test_experiment_name, scanner_name, model_name, input_ids_file):
     # ----------------------------------------------------------------------------------------
     training_experiment_dir = PROJECT_ROOT / 'outputs' / training_experiment_name
@@ -80,40 +121,58 @@ def main(training_experiment_name, test_experiment_name, scanner_name, model_nam
     regions_norm = np.true_divide(regions, tiv)
     age = dataset['Age'].values
 
-    # Create dataframe to hold actual and predicted ages
-    age_predictions = dataset[['image_id', 'Age']]
-    age_predictions = age_predictions.set_index('image_id')
-
     n_repetitions = 10
     n_folds = 10
 
-    for i_repetition in range(n_repetitions):
-        for i_fold in range(n_folds):
-
-            # Load model and scaler
-            prefix = f'{i_repetition:02d}_{i_fold:02d}'
-
-            model = load(training_cv_dir / f'{prefix}_regressor.joblib')
-            scaler = load(training_cv_dir / f'{prefix}_scaler.joblib')
-
-            # Use RobustScaler to transform testing data
-            x_test = scaler.transform(regions_norm)
-
-            # Apply model to scaled data
-            predictions = model.predict(x_test)
-
-            mae = mean_absolute_error(age, predictions)
-            rmse = sqrt(mean_squared_error(age, predictions))
-            r, _ = stats.pearsonr(age, predictions)
-            r2 = r2_score(age, predictions)
-            age_error_corr, _ = stats.spearmanr((predictions - age), age)
-
-            # Save prediction per model in df
-            age_predictions[f'Prediction {i_repetition:02d}_{i_fold:02d}'] = predictions
-
-            # Save model scores
-            scores_array = np.array([r, r2, mae, rmse, age_error_corr])
-            np.save(test_cv_dir / f'{prefix}_scores.npy', scores_array)
+    # Load all models (scaler and regressor pipelines) once, memory-mapping their arrays read-only
+    models = []
+    for i_repetition, i_fold in product(range(n_repetitions), range(n_folds)):
+        prefix = f'{i_repetition:02d}_{i_fold:02d}'
+        model = load(training_cv_dir / f'{prefix}_model.joblib', mmap_mode='r')
+        models.append((i_repetition, i_fold, model))
+
+    # Apply all models at once, one column of predictions per model
+    if all(isinstance(model.named_steps['regressor'], LinearSVR) for _, _, model in models):
+        # Linear SVMs: fold the scalers into the weights and predict with a single matrix product
+        # Single precision is sufficient for this product and halves its memory traffic
+        weights, intercepts = fold_scalers_into_linear_models([model for _, _, model in models])
+        predictions_all = (np.ascontiguousarray(regions_norm, dtype=np.float32) @ weights.T.astype(np.float32)
+                           + intercepts.astype(np.float32))
+
+        # Check the folded weights against the pipelines on the first subjects
+        n_checked_subjects = min(10, len(regions_norm))
+        pipeline_predictions = np.column_stack([model.predict(regions_norm[:n_checked_subjects])
+                                                for _, _, model in models])
+        if not np.allclose(predictions_all[:n_checked_subjects], pipeline_predictions, atol=1e-3):
+            raise ValueError('Predictions with the folded weights differ from the pipeline predictions.')
+    else:
+        # RVM and GPR models are applied through their own pipelines, in double precision
+        predictions_all = np.column_stack([model.predict(regions_norm) for _, _, model in models])
+
+    # Compute the scores of all models column-wise
+    errors = predictions_all - age[:, np.newaxis]
+    mae_all = np.mean(np.abs(errors), axis=0)
+    rmse_all = np.sqrt(np.mean(errors ** 2, axis=0))
+    r2_all = 1 - np.sum(errors ** 2, axis=0) / np.sum((age - age.mean()) ** 2)
+    r_all = corrcoef_columns(age, predictions_all)
+
+    # Spearman correlation between error and age, ranking age only once for all models
+    age_error_corr_all = corrcoef_columns(stats.rankdata(age), np.apply_along_axis(stats.rankdata, 0, errors))
+
+    # Create dataframe to hold actual and predicted ages, with one column of predictions per model
+    age_predictions = dataset[['image_id', 'Age']].set_index('image_id')
+    predictions_df = pd.DataFrame(predictions_all, index=age_predictions.index,
+                                  columns=[f'Prediction {i_repetition:02d}_{i_fold:02d}'
+                                           for i_repetition, i_fold, _ in models])
+    age_predictions = pd.concat([age_predictions, predictions_df], axis=1)
+
+    for i_model, (i_repetition, i_fold, _) in enumerate(models):
+        prefix = f'{i_repetition:02d}_{i_fold:02d}'
+
+        # Save model scores
+        scores_array = np.array([r_all[i_model], r2_all[i_model], mae_all[i_model], rmse_all[i_model],
+                                 age_error_corr_all[i_model]])
+        np.save(test_cv_dir / f'{prefix}_scores.npy', scores_array)
 
     # Save predictions
     age_predictions.to_csv(test_model_dir / 'age_predictions_test.csv')
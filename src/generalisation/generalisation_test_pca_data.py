@@ -10,7 +10,6 @@ Scanner2 data and saves all predictions per subjects in age_predictions_test.csv
 """
 import argparse
 import random
-from math import sqrt
 from pathlib import Path
 
 import numpy as np
@@ -108,7 +107,7 @@ def main(training_experiment_name, test_experiment_name, scanner_name, model_nam
             predictions = model.predict(x_test)
 
             mae = mean_absolute_error(age, predictions)
-            rmse = sqrt(mean_squared_error(age, predictions))
+            rmse = mean_squared_error(age, predictions, squared=False)
             r, _ = stats.pearsonr(age, predictions)
             r2 = r2_score(age, predictions)
             age_error_corr, _ = stats.spearmanr((predictions - age), age)
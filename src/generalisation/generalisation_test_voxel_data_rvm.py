@@ -9,7 +9,6 @@ per subjects in age_predictions_test.csv.
 """
 import argparse
 import random
-from math import sqrt
 from pathlib import Path
 
 import nibabel as nib
@@ -150,7 +149,7 @@ def main(training_experiment_name,
             predictions = age_predictions[f'Prediction {prefix}'].values
 
             mae = mean_absolute_error(age, predictions)
-            rmse = sqrt(mean_squared_error(age, predictions))
+            rmse = mean_squared_error(age, predictions, squared=False)
             r, _ = stats.pearsonr(age, predictions)
             r2 = r2_score(age, predictions)
             age_error_corr, _ = stats.spearmanr((predictions - age), age)
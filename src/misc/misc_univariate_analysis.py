@@ -15,7 +15,7 @@ from pathlib import Path
 
 import numpy as np
 import pandas as pd
-import statsmodels.api as sm
+from scipy import stats
 
 from utils import COLUMNS_NAME, load_freesurfer_dataset
 
@@ -57,36 +57,44 @@ def normalise_region_df(df, region_name):
     return df[region_name] / df['EstimatedTotalIntraCranialVol'] * 100
 
 
-def linear_regression(df, region_name):
+def linear_regression(exog, endog):
     """Perform linear regression using ordinary least squares (OLS) method
 
+    All regions share the same design matrix, so they are fitted at once
+    with a single pseudo-inverse of exog (the same estimator as statsmodels' OLS).
+
     Parameters
     ----------
-    df: dataframe
-        Dataset to be regressed
-    region_name: str
-        Region of interest
+    exog: ndarray
+        Design matrix, including the constant, of shape (n_subjects, n_params)
+    endog: ndarray
+        Dependent variables, one region per column, of shape (n_subjects, n_regions)
 
     Returns
     -------
-    OLS_results.params: ndarray
+    params: ndarray
         Estimated parameters
-    OLS_results.bse: float
+    bse: ndarray
         Standard error of the parameter estimates
-    OLS_results.tvalues: parameter
+    tvalues: ndarray
         t-statistic of parameter estimates
-    OLS_results.pvalues: float
+    pvalues: ndarray
         Two-tailed p-values of the t-statistics of the parameters
     """
+    pinv_exog = np.linalg.pinv(exog)
+    params = pinv_exog @ endog
 
-    endog = df['Norm_vol_' + region_name].values
-    exog = sm.add_constant(df[['Age', 'Age^2', 'Age^3']].values)
+    residuals = endog - exog @ params
+    df_resid = exog.shape[0] - np.linalg.matrix_rank(exog)
+    scale = np.sum(residuals ** 2, axis=0) / df_resid
 
-    OLS_model = sm.OLS(endog, exog)
+    normalized_cov_params = pinv_exog @ pinv_exog.T
+    bse = np.sqrt(np.outer(np.diag(normalized_cov_params), scale))
 
-    OLS_results = OLS_model.fit()
+    tvalues = params / bse
+    pvalues = stats.t.sf(np.abs(tvalues), df_resid) * 2
 
-    return OLS_results.params, OLS_results.bse, OLS_results.tvalues, OLS_results.pvalues
+    return params, bse, tvalues, pvalues
 
 
 def main(experiment_name, scanner_name, input_ids_file):
@@ -121,13 +129,17 @@ def main(experiment_name, scanner_name, input_ids_file):
     regression_output.set_index('Row_labels_stat', 'Row_labels_exog')
 
     for region_name in COLUMNS_NAME:
-        print(region_name)
         normalised_df['Norm_vol_' + region_name] = normalise_region_df(dataset, region_name)
 
-        # Linear regression - ordinary least squares (OLS)
-        coeff, std_err, t_value, p_value = linear_regression(normalised_df, region_name)
+    # Linear regression - ordinary least squares (OLS) of all regions on the same design matrix
+    exog = np.column_stack((np.ones(len(normalised_df)), normalised_df[['Age', 'Age^2', 'Age^3']].values))
+    endog = normalised_df[['Norm_vol_' + region_name for region_name in COLUMNS_NAME]].values
+
+    coeff, std_err, t_value, p_value = linear_regression(exog, endog)
 
-        regression_output[region_name] = np.concatenate((coeff, std_err, t_value, p_value), axis=0)
+    for i_region, region_name in enumerate(COLUMNS_NAME):
+        regression_output[region_name] = np.concatenate((coeff[:, i_region], std_err[:, i_region],
+                                                         t_value[:, i_region], p_value[:, i_region]), axis=0)
 
     # Output to csv
     regression_output.to_csv(univariate_dir / 'OLS_result.csv', index=False)
@@ -7,6 +7,10 @@ https://machinelearningmastery.com/calculate-bootstrap-confidence-intervals-mach
 import argparse
 from pathlib import Path
 
+import matplotlib
+
+matplotlib.use('Agg')
+
 import matplotlib.pyplot as plt
 import numpy as np
 
@@ -45,29 +49,13 @@ def main(experiment_name, model_name, n_bootstrap, n_min_pair, n_max_pair):
 
     i_n_subject_pairs_list = range(n_min_pair, n_max_pair + 1)
 
-    scores_i_n_subject_pairs = []
-    train_scores_i_n_subject_pairs = []
-    general_scores_i_n_subject_pairs = []
-
-    for i_n_subject_pairs in i_n_subject_pairs_list:
-        ids_with_n_subject_pairs_dir = experiment_dir / 'sample_size' / f'{i_n_subject_pairs:02d}'
-        scores_dir = ids_with_n_subject_pairs_dir / 'scores'
-        scores_bootstrap = []
-        train_scores_bootstrap = []
-        general_scores_bootstrap = []
-        for i_bootstrap in range(n_bootstrap):
-            filepath_scores = scores_dir / f'scores_{i_bootstrap:04d}_{model_name}.npy'
-            scores_bootstrap.append(np.load(str(filepath_scores))[1])
-
-            train_filepath_scores = scores_dir / f'scores_{i_bootstrap:04d}_{model_name}_train.npy'
-            train_scores_bootstrap.append(np.load(str(train_filepath_scores))[1])
-
-            general_filepath_scores = scores_dir / f'scores_{i_bootstrap:04d}_{model_name}_general.npy'
-            general_scores_bootstrap.append(np.load(str(general_filepath_scores))[1])
-
-        scores_i_n_subject_pairs.append(scores_bootstrap)
-        train_scores_i_n_subject_pairs.append(train_scores_bootstrap)
-        general_scores_i_n_subject_pairs.append(general_scores_bootstrap)
+    # Load the MAE of all bootstrap samples, arrays are indexed by (number of subject pairs - 1, bootstrap)
+    sample_size_dir = experiment_dir / 'sample_size'
+    selected = (slice(n_min_pair - 1, n_max_pair), slice(0, n_bootstrap), 1)
+
+    scores_i_n_subject_pairs = np.load(str(sample_size_dir / f'scores_{model_name}.npy'))[selected]
+    train_scores_i_n_subject_pairs = np.load(str(sample_size_dir / f'scores_{model_name}_train.npy'))[selected]
+    general_scores_i_n_subject_pairs = np.load(str(sample_size_dir / f'scores_{model_name}_general.npy'))[selected]
 
     age_min = 47
     age_max = 73
@@ -60,6 +60,9 @@ def main(experiment_name, scanner_name, input_ids_file, n_bootstrap, n_max_pair)
     age_min = int(dataset['Age'].min())  # 47
     age_max = int(dataset['Age'].max())  # 73
 
+    # Group subjects by age and gender once, instead of regrouping inside the bootstrap loops
+    age_gender_groups = {key: group for key, group in dataset.groupby(['Age', 'Gender'])}
+
     # Loop to create 20 bootstrap samples that each contain up to 20 gender-balanced subject pairs per age group/year
     # Create a out-of-bag set (~test set)
     for i_n_subject_pairs in range(1, n_max_pair + 1):
@@ -71,28 +74,28 @@ def main(experiment_name, scanner_name, input_ids_file, n_bootstrap, n_max_pair)
 
         # Loop to create 1000 random subject samples of the same size (with replacement) per bootstrap sample
         for i_bootstrap in range(n_bootstrap):
-            # Create empty df to add bootstrap subjects to
-            dataset_bootstrap_train = pd.DataFrame(columns=['image_id'])
-            dataset_bootstrap_test = pd.DataFrame(columns=['image_id'])
+            # Collect bootstrap subjects and concatenate them once at the end
+            samples_train = []
+            samples_test = []
 
             # Loop over ages (27 in total)
             for age in range(age_min, (age_max + 1)):
 
-                # Get dataset for specific age only
-                age_group = dataset.groupby('Age').get_group(age)
-
                 # Loop over genders (0: female, 1:male)
                 for gender in range(2):
-                    gender_group = age_group.groupby('Gender').get_group(gender)
+                    gender_group = age_gender_groups[(age, gender)]
 
                     # Extract random subject of that gender and add to dataset_bootstrap_train
                     random_sample_train = gender_group.sample(n=i_n_subject_pairs, replace=True)
-                    dataset_bootstrap_train = pd.concat([dataset_bootstrap_train, random_sample_train[['image_id']]])
+                    samples_train.append(random_sample_train[['image_id']])
 
                     # Sample test set with always the same size
                     not_sampled = ~gender_group['image_id'].isin(random_sample_train['image_id'])
                     random_sample_test = gender_group[not_sampled].sample(n=20, replace=False)
-                    dataset_bootstrap_test = pd.concat([dataset_bootstrap_test, random_sample_test[['image_id']]])
+                    samples_test.append(random_sample_test[['image_id']])
+
+            dataset_bootstrap_train = pd.concat(samples_train)
+            dataset_bootstrap_test = pd.concat(samples_test)
 
             # Export dataset_bootstrap_train as csv
             output_prefix = f'{i_bootstrap:04d}_{i_n_subject_pairs:02d}'
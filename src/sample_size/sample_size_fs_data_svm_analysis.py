@@ -3,17 +3,18 @@
 import argparse
 import random
 import warnings
-from math import sqrt
 from pathlib import Path
 
 import numpy as np
+import pandas as pd
 from scipy import stats
 from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
 from sklearn.model_selection import GridSearchCV, KFold
 from sklearn.preprocessing import RobustScaler
 from sklearn.svm import LinearSVR
 
-from utils import COLUMNS_NAME, load_freesurfer_dataset
+from utils import (COLUMNS_NAME, fast_spearman_coef, fast_spearman_coef_ranked, load_freesurfer_dataset,
+                   load_participants_data, select_freesurfer_dataset)
 
 PROJECT_ROOT = Path.cwd()
 
@@ -64,6 +65,10 @@ def main(experiment_name, scanner_name, n_bootstrap, n_max_pair,
     participants_path = PROJECT_ROOT / 'data' / 'BIOBANK' / scanner_name / 'participants.tsv'
     freesurfer_path = PROJECT_ROOT / 'data' / 'BIOBANK' / scanner_name / 'freesurferData.csv'
 
+    # Load the demographic and FreeSurfer data once, each bootstrap sample only selects its ids
+    participants_df = load_participants_data(participants_path)
+    freesurfer_df = pd.read_csv(freesurfer_path)
+
     general_participants_path = PROJECT_ROOT / 'data' / 'BIOBANK' / general_scanner_name / 'participants.tsv'
     general_freesurfer_path = PROJECT_ROOT / 'data' / 'BIOBANK' / general_scanner_name / 'freesurferData.csv'
 
@@ -78,27 +83,33 @@ def main(experiment_name, scanner_name, n_bootstrap, n_max_pair,
     x_general = np.true_divide(general_regions, general_tiv)
     y_general = general_dataset['Age'].values
 
+    # Rank the generalisation ages once, they are the same for all bootstrap samples
+    y_general_ranks = stats.rankdata(y_general)
+
     # ----------------------------------------------------------------------------------------
 
+    # Scores (r2, mae, rmse, age_error_corr) of all bootstrap samples, saved once per number of subject pairs
+    sample_size_dir = experiment_dir / 'sample_size'
+    all_scores = np.full((n_max_pair, n_bootstrap, 4), np.nan)
+    all_train_scores = np.full((n_max_pair, n_bootstrap, 4), np.nan)
+    all_general_scores = np.full((n_max_pair, n_bootstrap, 4), np.nan)
+
     # Loop over the 20 bootstrap samples with up to 20 gender-balanced subject pairs per age group/year
     for i_n_subject_pairs in range(1, n_max_pair + 1):
         print(f'Bootstrap number of subject pairs: {i_n_subject_pairs}')
         ids_with_n_subject_pairs_dir = experiment_dir / 'sample_size' / f'{i_n_subject_pairs:02d}' / 'ids'
 
-        scores_dir = experiment_dir / 'sample_size' / f'{i_n_subject_pairs:02d}' / 'scores'
-        scores_dir.mkdir(exist_ok=True)
-
         # Loop over the 1000 random subject samples per bootstrap
         for i_bootstrap in range(n_bootstrap):
             print(f'Sample number within bootstrap: {i_bootstrap}')
 
             prefix = f'{i_bootstrap:04d}_{i_n_subject_pairs:02d}'
-            train_dataset = load_freesurfer_dataset(participants_path,
-                                                    ids_with_n_subject_pairs_dir / f'{prefix}_train.csv',
-                                                    freesurfer_path)
-            test_dataset = load_freesurfer_dataset(participants_path,
-                                                   ids_with_n_subject_pairs_dir / f'{prefix}_test.csv',
-                                                   freesurfer_path)
+            train_dataset = select_freesurfer_dataset(participants_df,
+                                                      ids_with_n_subject_pairs_dir / f'{prefix}_train.csv',
+                                                      freesurfer_df)
+            test_dataset = select_freesurfer_dataset(participants_df,
+                                                     ids_with_n_subject_pairs_dir / f'{prefix}_test.csv',
+                                                     freesurfer_df)
 
             # Initialise random seed
             np.random.seed(42)
@@ -142,35 +153,41 @@ def main(experiment_name, scanner_name, n_bootstrap, n_max_pair,
             # Test data
             predictions = best_model.predict(x_test)
             mae = mean_absolute_error(y_test, predictions)
-            rmse = sqrt(mean_squared_error(y_test, predictions))
+            rmse = mean_squared_error(y_test, predictions, squared=False)
             r2 = r2_score(y_test, predictions)
-            age_error_corr, _ = stats.spearmanr(np.abs(y_test - predictions), y_test)
+            age_error_corr = fast_spearman_coef(np.abs(y_test - predictions), y_test)
 
-            scores = np.array([r2, mae, rmse, age_error_corr])
-            np.save(str(scores_dir / f'scores_{i_bootstrap:04d}_{model_name}.npy'), scores)
+            all_scores[i_n_subject_pairs - 1, i_bootstrap] = [r2, mae, rmse, age_error_corr]
 
             print(f'R2: {r2:0.3f} MAE: {mae:0.3f} RMSE: {rmse:0.3f} CORR: {age_error_corr:0.3f}')
 
             # Train data
             train_predictions = best_model.predict(x_train)
             train_mae = mean_absolute_error(y_train, train_predictions)
-            train_rmse = sqrt(mean_squared_error(y_train, train_predictions))
+            train_rmse = mean_squared_error(y_train, train_predictions, squared=False)
             train_r2 = r2_score(y_train, train_predictions)
-            train_age_error_corr, _ = stats.spearmanr(np.abs(y_train - train_predictions), y_train)
+            train_age_error_corr = fast_spearman_coef(np.abs(y_train - train_predictions), y_train)
 
-            train_scores = np.array([train_r2, train_mae, train_rmse, train_age_error_corr])
-            np.save(str(scores_dir / f'scores_{i_bootstrap:04d}_{model_name}_train.npy'), train_scores)
+            all_train_scores[i_n_subject_pairs - 1, i_bootstrap] = [train_r2, train_mae, train_rmse,
+                                                                    train_age_error_corr]
 
             # Generalisation data
             x_general_norm = scaler.transform(x_general)
             general_predictions = best_model.predict(x_general_norm)
             general_mae = mean_absolute_error(y_general, general_predictions)
-            general_rmse = sqrt(mean_squared_error(y_general, general_predictions))
+            general_rmse = mean_squared_error(y_general, general_predictions, squared=False)
             general_r2 = r2_score(y_general, general_predictions)
-            general_age_error_corr, _ = stats.spearmanr(np.abs(y_general - general_predictions), y_general)
+            general_age_error_corr = fast_spearman_coef_ranked(np.abs(y_general - general_predictions),
+                                                               y_general_ranks)
+
+            all_general_scores[i_n_subject_pairs - 1, i_bootstrap] = [general_r2, general_mae, general_rmse,
+                                                                      general_age_error_corr]
+
+        # Save the scores of all bootstrap samples computed so far
+        np.save(str(sample_size_dir / f'scores_{model_name}.npy'), all_scores)
+        np.save(str(sample_size_dir / f'scores_{model_name}_train.npy'), all_train_scores)
+        np.save(str(sample_size_dir / f'scores_{model_name}_general.npy'), all_general_scores)
 
-            general_scores = np.array([general_r2, general_mae, general_rmse, train_age_error_corr])
-            np.save(str(scores_dir / f'scores_{i_bootstrap:04d}_{model_name}_general.npy'), general_scores)
 
 if __name__ == '__main__':
     main(args.experiment_name, args.scanner_name,
@@ -3,7 +3,6 @@
 import argparse
 import random
 import warnings
-from math import sqrt
 from pathlib import Path
 import gc
 
@@ -19,7 +18,8 @@ from tqdm import tqdm
 import pandas as pd
 from sklearn.decomposition import PCA
 
-from utils import COLUMNS_NAME, load_demographic_data
+from utils import (COLUMNS_NAME, fast_spearman_coef, fast_spearman_coef_ranked, load_demographic_data,
+                   load_participants_data, select_demographic_data)
 
 PROJECT_ROOT = Path.cwd()
 
@@ -90,6 +90,9 @@ def main(experiment_name, scanner_name, input_path, n_bootstrap, n_max_pair,
     experiment_dir = PROJECT_ROOT / 'outputs' / experiment_name
     participants_path = PROJECT_ROOT / 'data' / 'BIOBANK' / scanner_name / 'participants.tsv'
 
+    # Load the demographic data once, each bootstrap sample only selects its ids
+    participants_df = load_participants_data(participants_path)
+
     general_participants_path = PROJECT_ROOT / 'data' / 'BIOBANK' / general_scanner_name / 'participants.tsv'
 
     general_ids_path = PROJECT_ROOT / 'outputs' / general_experiment_name / general_input_ids_file
@@ -117,26 +120,32 @@ def main(experiment_name, scanner_name, input_path, n_bootstrap, n_max_pair,
     dataset_site2 = load_all_subjects(subjects_path_2, mask_img)
     x_general = np.array(dataset_site2)
     y_general = general_dataset['Age'].values
+
+    # Rank the generalisation ages once, they are the same for all bootstrap samples
+    y_general_ranks = stats.rankdata(y_general)
     # ----------------------------------------------------------------------------------------
 
+    # Scores (r2, mae, rmse, age_error_corr) of all bootstrap samples, saved once per number of subject pairs
+    sample_size_dir = experiment_dir / 'sample_size'
+    all_scores = np.full((n_max_pair, n_bootstrap, 4), np.nan)
+    all_train_scores = np.full((n_max_pair, n_bootstrap, 4), np.nan)
+    all_general_scores = np.full((n_max_pair, n_bootstrap, 4), np.nan)
+
     # Loop over the 20 bootstrap samples with up to 20 gender-balanced subject pairs per age group/year
     for i_n_subject_pairs in range(3, n_max_pair + 1):
         print(f'Bootstrap number of subject pairs: {i_n_subject_pairs}')
         ids_with_n_subject_pairs_dir = experiment_dir / 'sample_size' / f'{i_n_subject_pairs:02d}' / 'ids'
 
-        scores_dir = experiment_dir / 'sample_size' / f'{i_n_subject_pairs:02d}' / 'scores'
-        scores_dir.mkdir(exist_ok=True)
-
         # Loop over the 1000 random subject samples per bootstrap
         for i_bootstrap in range(n_bootstrap):
             print(f'Sample number within bootstrap: {i_bootstrap}')
 
             prefix = f'{i_bootstrap:04d}_{i_n_subject_pairs:02d}'
-            train_ids = load_demographic_data(participants_path,
-                                                    ids_with_n_subject_pairs_dir / f'{prefix}_train.csv')
+            train_ids = select_demographic_data(participants_df,
+                                                ids_with_n_subject_pairs_dir / f'{prefix}_train.csv')
 
-            test_ids = load_demographic_data(participants_path,
-                                                   ids_with_n_subject_pairs_dir / f'{prefix}_test.csv')
+            test_ids = select_demographic_data(participants_df,
+                                               ids_with_n_subject_pairs_dir / f'{prefix}_test.csv')
 
             # Initialise random seed
             np.random.seed(42)
@@ -194,15 +203,11 @@ def main(experiment_name, scanner_name, input_path, n_bootstrap, n_max_pair,
             # Test data
             predictions = best_model.predict(x_test)
             mae = mean_absolute_error(y_test, predictions)
-            rmse = sqrt(mean_squared_error(y_test, predictions))
+            rmse = mean_squared_error(y_test, predictions, squared=False)
             r2 = r2_score(y_test, predictions)
-            age_error_corr, _ = stats.spearmanr(np.abs(y_test - predictions),
-                                                y_test)
+            age_error_corr = fast_spearman_coef(np.abs(y_test - predictions), y_test)
 
-            scores = np.array([r2, mae, rmse, age_error_corr])
-            np.save(
-                str(scores_dir / f'scores_{i_bootstrap:04d}_{model_name}.npy'),
-                scores)
+            all_scores[i_n_subject_pairs - 1, i_bootstrap] = [r2, mae, rmse, age_error_corr]
 
             print(
                 f'R2: {r2:0.3f} MAE: {mae:0.3f} RMSE: {rmse:0.3f} CORR: {age_error_corr:0.3f}')
@@ -210,37 +215,34 @@ def main(experiment_name, scanner_name, input_path, n_bootstrap, n_max_pair,
             # Train data
             train_predictions = best_model.predict(x_train)
             train_mae = mean_absolute_error(y_train, train_predictions)
-            train_rmse = sqrt(mean_squared_error(y_train, train_predictions))
+            train_rmse = mean_squared_error(y_train, train_predictions, squared=False)
             train_r2 = r2_score(y_train, train_predictions)
-            train_age_error_corr, _ = stats.spearmanr(
-                np.abs(y_train - train_predictions), y_train)
+            train_age_error_corr = fast_spearman_coef(np.abs(y_train - train_predictions), y_train)
 
-            train_scores = np.array(
-                [train_r2, train_mae, train_rmse, train_age_error_corr])
-            np.save(str(
-                scores_dir / f'scores_{i_bootstrap:04d}_{model_name}_train.npy'),
-                    train_scores)
+            all_train_scores[i_n_subject_pairs - 1, i_bootstrap] = [train_r2, train_mae, train_rmse,
+                                                                    train_age_error_corr]
 
             # Generalisation data
             x_general_components = pca.transform(x_general)
             x_general_norm = scaler.transform(x_general_components)
             general_predictions = best_model.predict(x_general_norm)
             general_mae = mean_absolute_error(y_general, general_predictions)
-            general_rmse = sqrt(
-                mean_squared_error(y_general, general_predictions))
+            general_rmse = mean_squared_error(y_general, general_predictions, squared=False)
             general_r2 = r2_score(y_general, general_predictions)
-            general_age_error_corr, _ = stats.spearmanr(
-                np.abs(y_general - general_predictions), y_general)
+            general_age_error_corr = fast_spearman_coef_ranked(np.abs(y_general - general_predictions),
+                                                               y_general_ranks)
 
-            general_scores = np.array(
-                [general_r2, general_mae, general_rmse, train_age_error_corr])
-            np.save(str(
-                scores_dir / f'scores_{i_bootstrap:04d}_{model_name}_general.npy'),
-                    general_scores)
+            all_general_scores[i_n_subject_pairs - 1, i_bootstrap] = [general_r2, general_mae, general_rmse,
+                                                                      general_age_error_corr]
 
             del pca, test_data, train_data
             gc.collect()
 
+        # Save the scores of all bootstrap samples computed so far
+        np.save(str(sample_size_dir / f'scores_{model_name}.npy'), all_scores)
+        np.save(str(sample_size_dir / f'scores_{model_name}_train.npy'), all_train_scores)
+        np.save(str(sample_size_dir / f'scores_{model_name}_general.npy'), all_general_scores)
+
 
 if __name__ == '__main__':
     main(args.experiment_name, args.scanner_name,
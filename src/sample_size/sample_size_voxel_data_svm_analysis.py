@@ -3,17 +3,32 @@
 import argparse
 import random
 import warnings
-from math import sqrt
 from pathlib import Path
 
 import numpy as np
-import pandas as pd
+from joblib import Parallel, delayed
 from scipy import stats
+
+try:
+    # Train SVR on the GPU when RAPIDS cuML is installed
+    import cuml.accel
+    cuml.accel.install()
+    GPU_ACCELERATED = True
+except ImportError:
+    GPU_ACCELERATED = False
+    try:
+        # Otherwise train SVR with the oneDAL solvers when Intel Extension for Scikit-learn is installed
+        from sklearnex import patch_sklearn
+        patch_sklearn()
+    except ImportError:
+        pass
+
 from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
 from sklearn.model_selection import GridSearchCV, KFold
 from sklearn.svm import SVR
 
-from utils import load_demographic_data
+from utils import (fast_spearman_coef, fast_spearman_coef_ranked, load_demographic_data, load_kernel,
+                   load_participants_data, select_demographic_data)
 
 PROJECT_ROOT = Path.cwd()
 
@@ -52,113 +67,174 @@ parser.add_argument('-I', '--general_input_ids_file',
                     default='cleaned_ids.csv',
                     help='Filename indicating the ids to be used.')
 
+# The accelerator is only installed in the main process and all samples share the GPU,
+# so the samples run one at a time by default when training on the GPU
+parser.add_argument('-J', '--n_jobs',
+                    dest='n_jobs',
+                    type=int, default=1 if GPU_ACCELERATED else -1,
+                    help='Number of parallel jobs (1 by default when training on the GPU, all CPUs otherwise).')
+
 args = parser.parse_args()
 
 
-def main(experiment_name, scanner_name, n_bootstrap, n_max_pair,
-         general_experiment_name, general_scanner_name, general_input_ids_file):
-    # ----------------------------------------------------------------------------------------
-    model_name = 'voxel_SVM'
+def _select_bootstrap_rows(participants_df, experiment_dir, i_n_subject_pairs, i_bootstrap,
+                           id_to_row, general_id_to_row):
+    """Select the kernel rows and ages of the training and test ids of one bootstrap sample.
 
-    experiment_dir = PROJECT_ROOT / 'outputs' / experiment_name
-    participants_path = PROJECT_ROOT / 'data' / 'BIOBANK' / scanner_name / 'participants.tsv'
+    Returns:
+        train_rows: rows of the training subjects in the kernel.
+        test_rows: rows of the test subjects in the kernel.
+        general_rows: rows of the training subjects in the generalisation kernel.
+        y_train: ages of the training subjects.
+        y_test: ages of the test subjects.
+    """
+    ids_with_n_subject_pairs_dir = experiment_dir / 'sample_size' / f'{i_n_subject_pairs:02d}' / 'ids'
 
-    # Load the Gram matrix
-    kernel_path = PROJECT_ROOT / 'outputs' / 'kernels' / 'kernel.csv'
-    kernel = pd.read_csv(kernel_path, header=0, index_col=0)
+    prefix = f'{i_bootstrap:04d}_{i_n_subject_pairs:02d}'
+    train_dataset = select_demographic_data(participants_df,
+                                            ids_with_n_subject_pairs_dir / f'{prefix}_train.csv')
+    test_dataset = select_demographic_data(participants_df,
+                                           ids_with_n_subject_pairs_dir / f'{prefix}_test.csv')
 
-    general_participants_path = PROJECT_ROOT / 'data' / 'BIOBANK' / general_scanner_name / 'participants.tsv'
-    general_ids_path = PROJECT_ROOT / 'outputs' / general_experiment_name / general_input_ids_file
+    train_rows = np.fromiter((id_to_row[image_id] for image_id in train_dataset['image_id']),
+                             dtype=np.intp, count=len(train_dataset))
+    test_rows = np.fromiter((id_to_row[image_id] for image_id in test_dataset['image_id']),
+                            dtype=np.intp, count=len(test_dataset))
+    general_rows = np.fromiter((general_id_to_row[image_id] for image_id in train_dataset['image_id']),
+                               dtype=np.intp, count=len(train_dataset))
 
-    kernel_path_general = PROJECT_ROOT / 'outputs' / 'kernels' / 'kernel_general.csv'
-    kernel_general = pd.read_csv(kernel_path_general, header=0, index_col=0)
-    general_dataset = load_demographic_data(general_participants_path, general_ids_path)
+    return train_rows, test_rows, general_rows, train_dataset['Age'].values, test_dataset['Age'].values
 
-    y_general = general_dataset['Age'].values
 
-    # ----------------------------------------------------------------------------------------
-    # Loop over the 20 bootstrap samples with up to 20 gender-balanced subject pairs per age group/year
-    for i_n_subject_pairs in range(1, n_max_pair + 1):
-        print(f'Bootstrap number of subject pairs: {i_n_subject_pairs}')
-        ids_with_n_subject_pairs_dir = experiment_dir / 'sample_size' / f'{i_n_subject_pairs:02d}' / 'ids'
+def _one_bootstrap(i_bootstrap, train_rows, test_rows, general_rows, y_train, y_test,
+                   kernel_values, kernel_general_values, y_general, y_general_ranks):
+    """Train and evaluate the SVM on one bootstrap sample and return its scores."""
+    print(f'Sample number within bootstrap: {i_bootstrap}')
+
+    # Initialise random seed
+    np.random.seed(42)
+    random.seed(42)
+
+    x_train = kernel_values[np.ix_(train_rows, train_rows)]
+    x_test = kernel_values[np.ix_(test_rows, train_rows)]
 
-        scores_dir = experiment_dir / 'sample_size' / f'{i_n_subject_pairs:02d}' / 'scores'
-        scores_dir.mkdir(exist_ok=True)
+    model = SVR(kernel='precomputed')
 
-        # Loop over the 1000 random subject samples per bootstrap
-        for i_bootstrap in range(n_bootstrap):
-            print(f'Sample number within bootstrap: {i_bootstrap}')
+    # Systematic search for best hyperparameters
+    # The bootstrap samples already run in parallel, so the nested search stays serial
+    search_space = {'C': [2 ** -7, 2 ** -5, 2 ** -3, 2 ** -1, 2 ** 0, 2 ** 1, 2 ** 3, 2 ** 5, 2 ** 7]}
+    n_nested_folds = 5
+    nested_kf = KFold(n_splits=n_nested_folds, shuffle=True, random_state=i_bootstrap)
+    gridsearch = GridSearchCV(model,
+                              param_grid=search_space,
+                              scoring='neg_mean_absolute_error',
+                              refit=True, cv=nested_kf,
+                              verbose=0, n_jobs=1)
 
-            prefix = f'{i_bootstrap:04d}_{i_n_subject_pairs:02d}'
-            train_dataset = load_demographic_data(participants_path,
-                                                  ids_with_n_subject_pairs_dir / f'{prefix}_train.csv')
-            test_dataset = load_demographic_data(participants_path,
-                                                 ids_with_n_subject_pairs_dir / f'{prefix}_test.csv')
+    gridsearch.fit(x_train, y_train)
 
-            # Initialise random seed
-            np.random.seed(42)
-            random.seed(42)
+    best_model = gridsearch.best_estimator_
 
-            train_index = train_dataset['image_id']
-            test_index = test_dataset['image_id']
+    # Test data
+    predictions = best_model.predict(x_test)
+    mae = mean_absolute_error(y_test, predictions)
+    rmse = mean_squared_error(y_test, predictions, squared=False)
+    r2 = r2_score(y_test, predictions)
+    age_error_corr = fast_spearman_coef(np.abs(y_test - predictions), y_test)
 
-            x_train = kernel.loc[train_index, train_index].values
-            x_test = kernel.loc[test_index, train_index].values
+    scores = [r2, mae, rmse, age_error_corr]
 
-            y_train = train_dataset['Age'].values
-            y_test = test_dataset['Age'].values
+    print(f'R2: {r2:0.3f} MAE: {mae:0.3f} RMSE: {rmse:0.3f} CORR: {age_error_corr:0.3f}')
 
-            model = SVR(kernel='precomputed')
+    # Train data
+    train_predictions = best_model.predict(x_train)
+    train_mae = mean_absolute_error(y_train, train_predictions)
+    train_rmse = mean_squared_error(y_train, train_predictions, squared=False)
+    train_r2 = r2_score(y_train, train_predictions)
+    train_age_error_corr = fast_spearman_coef(np.abs(y_train - train_predictions), y_train)
 
-            # Systematic search for best hyperparameters
-            search_space = {'C': [2 ** -7, 2 ** -5, 2 ** -3, 2 ** -1, 2 ** 0, 2 ** 1, 2 ** 3, 2 ** 5, 2 ** 7]}
-            n_nested_folds = 5
-            nested_kf = KFold(n_splits=n_nested_folds, shuffle=True, random_state=i_bootstrap)
-            gridsearch = GridSearchCV(model,
-                                      param_grid=search_space,
-                                      scoring='neg_mean_absolute_error',
-                                      refit=True, cv=nested_kf,
-                                      verbose=0, n_jobs=1)
+    train_scores = [train_r2, train_mae, train_rmse, train_age_error_corr]
 
-            gridsearch.fit(x_train, y_train)
+    # Generalisation data
+    x_general = kernel_general_values[general_rows].T
+    general_predictions = best_model.predict(x_general)
+    general_mae = mean_absolute_error(y_general, general_predictions)
+    general_rmse = mean_squared_error(y_general, general_predictions, squared=False)
+    general_r2 = r2_score(y_general, general_predictions)
+    general_age_error_corr = fast_spearman_coef_ranked(np.abs(y_general - general_predictions),
+                                                       y_general_ranks)
 
-            best_model = gridsearch.best_estimator_
+    general_scores = [general_r2, general_mae, general_rmse, general_age_error_corr]
 
-            # Test data
-            predictions = best_model.predict(x_test)
-            mae = mean_absolute_error(y_test, predictions)
-            rmse = sqrt(mean_squared_error(y_test, predictions))
-            r2 = r2_score(y_test, predictions)
-            age_error_corr, _ = stats.spearmanr(np.abs(y_test - predictions), y_test)
+    return scores, train_scores, general_scores
 
-            scores = np.array([r2, mae, rmse, age_error_corr])
-            np.save(str(scores_dir / f'scores_{i_bootstrap:04d}_{model_name}.npy'), scores)
 
-            print(f'R2: {r2:0.3f} MAE: {mae:0.3f} RMSE: {rmse:0.3f} CORR: {age_error_corr:0.3f}')
+def main(experiment_name, scanner_name, n_bootstrap, n_max_pair,
+         general_experiment_name, general_scanner_name, general_input_ids_file, n_jobs):
+    # ----------------------------------------------------------------------------------------
+    model_name = 'voxel_SVM'
 
-            # Train data
-            train_predictions = best_model.predict(x_train)
-            train_mae = mean_absolute_error(y_train, train_predictions)
-            train_rmse = sqrt(mean_squared_error(y_train, train_predictions))
-            train_r2 = r2_score(y_train, train_predictions)
-            train_age_error_corr, _ = stats.spearmanr(np.abs(y_train - train_predictions), y_train)
+    experiment_dir = PROJECT_ROOT / 'outputs' / experiment_name
+    participants_path = PROJECT_ROOT / 'data' / 'BIOBANK' / scanner_name / 'participants.tsv'
 
-            train_scores = np.array([train_r2, train_mae, train_rmse, train_age_error_corr])
-            np.save(str(scores_dir / f'scores_{i_bootstrap:04d}_{model_name}_train.npy'), train_scores)
+    # Load the demographic data once, each bootstrap sample only selects its ids
+    participants_df = load_participants_data(participants_path)
 
-            # Generalisation data
-            x_general = kernel_general.loc[train_index, :].T.values
-            general_predictions = best_model.predict(x_general)
-            general_mae = mean_absolute_error(y_general, general_predictions)
-            general_rmse = sqrt(mean_squared_error(y_general, general_predictions))
-            general_r2 = r2_score(y_general, general_predictions)
-            general_age_error_corr, _ = stats.spearmanr(np.abs(y_general - general_predictions), y_general)
+    # Load the Gram matrix as a float32 memory map, which joblib passes to the workers by file reference
+    kernel_path = PROJECT_ROOT / 'outputs' / 'kernels' / 'kernel.csv'
+    kernel_values, kernel_ids, _ = load_kernel(kernel_path)
+
+    general_participants_path = PROJECT_ROOT / 'data' / 'BIOBANK' / general_scanner_name / 'participants.tsv'
+    general_ids_path = PROJECT_ROOT / 'outputs' / general_experiment_name / general_input_ids_file
 
-            general_scores = np.array([general_r2, general_mae, general_rmse, train_age_error_corr])
-            np.save(str(scores_dir / f'scores_{i_bootstrap:04d}_{model_name}_general.npy'), general_scores)
+    kernel_path_general = PROJECT_ROOT / 'outputs' / 'kernels' / 'kernel_general.csv'
+    kernel_general_values, kernel_general_ids, _ = load_kernel(kernel_path_general)
+    general_dataset = load_demographic_data(general_participants_path, general_ids_path)
+
+    # Map image ids to rows once, avoiding pandas reindexing inside the loop
+    id_to_row = {image_id: i_row for i_row, image_id in enumerate(kernel_ids)}
+    general_id_to_row = {image_id: i_row for i_row, image_id in enumerate(kernel_general_ids)}
+
+    y_general = general_dataset['Age'].values
+
+    # Rank the generalisation ages once, they are the same for all bootstrap samples
+    y_general_ranks = stats.rankdata(y_general)
+
+    # ----------------------------------------------------------------------------------------
+    # Scores (r2, mae, rmse, age_error_corr) of all bootstrap samples, saved once per number of subject pairs
+    sample_size_dir = experiment_dir / 'sample_size'
+    all_scores = np.full((n_max_pair, n_bootstrap, 4), np.nan)
+    all_train_scores = np.full((n_max_pair, n_bootstrap, 4), np.nan)
+    all_general_scores = np.full((n_max_pair, n_bootstrap, 4), np.nan)
+
+    # The workers are reused by all batches
+    with Parallel(n_jobs=n_jobs, backend='loky') as parallel:
+        # Loop over the 20 bootstrap samples with up to 20 gender-balanced subject pairs per age group/year
+        for i_n_subject_pairs in range(1, n_max_pair + 1):
+            print(f'Bootstrap number of subject pairs: {i_n_subject_pairs}')
+
+            # Run the 1000 random subject samples per bootstrap in parallel
+            # The kernel rows are selected in the main process, so only small index arrays are sent to the workers
+            results = parallel(
+                delayed(_one_bootstrap)(i_bootstrap,
+                                        *_select_bootstrap_rows(participants_df, experiment_dir,
+                                                                i_n_subject_pairs, i_bootstrap,
+                                                                id_to_row, general_id_to_row),
+                                        kernel_values, kernel_general_values, y_general, y_general_ranks)
+                for i_bootstrap in range(n_bootstrap))
+
+            (all_scores[i_n_subject_pairs - 1],
+             all_train_scores[i_n_subject_pairs - 1],
+             all_general_scores[i_n_subject_pairs - 1]) = (np.array(scores) for scores in zip(*results))
+
+            # Save the scores of all bootstrap samples computed so far
+            np.save(str(sample_size_dir / f'scores_{model_name}.npy'), all_scores)
+            np.save(str(sample_size_dir / f'scores_{model_name}_train.npy'), all_train_scores)
+            np.save(str(sample_size_dir / f'scores_{model_name}_general.npy'), all_general_scores)
 
 
 if __name__ == '__main__':
     main(args.experiment_name, args.scanner_name,
          args.n_bootstrap, args.n_max_pair,
-         args.general_experiment_name, args.general_scanner_name, args.general_input_ids_file)
+         args.general_experiment_name, args.general_scanner_name, args.general_input_ids_file,
+         args.n_jobs)
@@ -1,4 +1,6 @@
 """Helper functions and constants."""
+import os
+
 import pandas as pd
 import numpy as np
 from scipy import stats
@@ -6,20 +8,38 @@ from scipy import stats
 
 def load_freesurfer_dataset(participants_path, ids_path, freesurfer_path):
     """Load dataset."""
-    demographic_data = load_demographic_data(participants_path, ids_path)
-
+    participants_df = load_participants_data(participants_path)
     freesurfer_df = pd.read_csv(freesurfer_path)
 
-    dataset_df = pd.merge(freesurfer_df, demographic_data, on='image_id')
-
-    return dataset_df
+    return select_freesurfer_dataset(participants_df, ids_path, freesurfer_df)
 
 
 def load_demographic_data(participants_path, ids_path):
     """Load dataset using selected ids."""
+    participants_df = load_participants_data(participants_path)
+
+    return select_demographic_data(participants_df, ids_path)
+
+
+def load_participants_data(participants_path):
+    """Load demographic data of all participants."""
     participants_df = pd.read_csv(participants_path, sep='\t')
     participants_df = participants_df.dropna()
 
+    return participants_df
+
+
+def select_freesurfer_dataset(participants_df, ids_path, freesurfer_df):
+    """Select FreeSurfer and demographic data of the selected ids from already loaded data."""
+    demographic_data = select_demographic_data(participants_df, ids_path)
+
+    dataset_df = pd.merge(freesurfer_df, demographic_data, on='image_id')
+
+    return dataset_df
+
+
+def select_demographic_data(participants_df, ids_path):
+    """Select demographic data of the selected ids from already loaded data."""
     ids_df = pd.read_csv(ids_path, usecols=['image_id'])
 
     ids_df['participant_id'] = ids_df['image_id'].str.split('_').str[0]
@@ -29,6 +49,54 @@ def load_demographic_data(participants_path, ids_path):
     return dataset_df
 
 
+def load_kernel(kernel_path):
+    """Load a Gram matrix saved as csv as a read-only float32 memory map.
+
+    The csv file is converted once into npy files next to it (the matrix and the image ids of its rows
+    and columns), which are reused as long as they are newer than the csv file.
+
+    Returns:
+        kernel: memory-mapped Gram matrix, shape (n_row_ids, n_column_ids).
+        row_ids: image ids of the rows.
+        column_ids: image ids of the columns.
+    """
+    kernel_npy_path = kernel_path.with_suffix('.npy')
+    row_ids_path = kernel_path.with_name(f'{kernel_path.stem}_row_ids.npy')
+    column_ids_path = kernel_path.with_name(f'{kernel_path.stem}_column_ids.npy')
+
+    if not kernel_npy_path.exists() or kernel_npy_path.stat().st_mtime < kernel_path.stat().st_mtime:
+        kernel_df = pd.read_csv(kernel_path, header=0, index_col=0)
+
+        # Save the matrix last, so its modification time marks a complete conversion
+        _save_npy_atomic(row_ids_path, kernel_df.index.values.astype(str))
+        _save_npy_atomic(column_ids_path, kernel_df.columns.values.astype(str))
+        _save_npy_atomic(kernel_npy_path, kernel_df.values.astype(np.float32))
+
+    kernel = np.load(str(kernel_npy_path), mmap_mode='r')
+    row_ids = np.load(str(row_ids_path))
+    column_ids = np.load(str(column_ids_path))
+
+    return kernel, row_ids, column_ids
+
+
+def _save_npy_atomic(path, array):
+    """Save an array to a temporary npy file and move it into place, so readers never see a partial file."""
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as tmp_file:
+        np.save(tmp_file, array)
+    os.replace(tmp_path, path)
+
+
+def fast_spearman_coef(a, b):
+    """Spearman correlation coefficient, without computing its p-value."""
+    return fast_spearman_coef_ranked(a, stats.rankdata(b))
+
+
+def fast_spearman_coef_ranked(a, b_ranks):
+    """Spearman correlation coefficient between a and an array of which the ranks are already computed."""
+    return np.corrcoef(stats.rankdata(a), b_ranks)[0, 1]
+
+
 def ttest_ind_corrected(performance_a, performance_b, k=10, r=10):
     """Corrected repeated k-fold cv test.
      The test assumes that the classifiers were evaluated using cross validation.